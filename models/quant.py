@@ -14,6 +14,11 @@ from torch.nn import functional as F
 import math
 import dist
 
+try:  # optional: approximate nearest-code search for eval-time quantization
+    import faiss
+except ImportError:
+    faiss = None
+
 
 # this file only defines the VectorQuantizer2 used in VQVAE
 __all__ = [
@@ -21,6 +26,52 @@ __all__ = [
 ]
 
 
+def _residual_update_(
+    f_hat: torch.Tensor, f_rest: torch.Tensor, h_BChw: torch.Tensor
+):
+    # no-grad paths: read h_BChw once and update both accumulators in place
+    f_hat.add_(h_BChw)
+    f_rest.sub_(h_BChw)
+
+
+def _residual_update(
+    f_hat: torch.Tensor, f_rest: torch.Tensor, h_BChw: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    # training path: mse_loss saves f_hat for backward at every scale, so the
+    # f_hat update must stay out of place here
+    return f_hat + h_BChw, f_rest - h_BChw
+
+
+# below this patch size the input has too few distinct values for the 4-tap
+# bicubic filter to add anything over nearest + \phi's own 3x3 smoothing conv
+BICUBIC_MIN_PN = 4
+
+
+def _upsample_phi(
+    h_BChw: torch.Tensor, size: Tuple[int, int], phi: nn.Module
+) -> torch.Tensor:
+    # upsample + \phi residual conv as one compiled region, so the upsampled
+    # (B,C,H,W) tensor is not written out and re-read by the conv
+    mode = "bicubic" if h_BChw.shape[-1] >= BICUBIC_MIN_PN else "nearest"
+    return phi(F.interpolate(h_BChw, size=size, mode=mode))
+
+
+def _accumulate_and_pool(
+    f_hat: torch.Tensor, h: torch.Tensor, size: Tuple[int, int]
+) -> torch.Tensor:
+    # inference AR step: accumulate into f_hat in place and area-pool the
+    # result down to the next scale without an intermediate round trip
+    f_hat.add_(h)
+    return F.interpolate(f_hat, size=size, mode="area")
+
+
+if hasattr(torch, "compile"):  # fuse the pair into a single pointwise kernel
+    _residual_update_ = torch.compile(_residual_update_)
+    _residual_update = torch.compile(_residual_update)
+    _upsample_phi = torch.compile(_upsample_phi)
+    _accumulate_and_pool = torch.compile(_accumulate_and_pool)
+
+
 class VectorQuantizer2(nn.Module):
     # VQGAN originally use beta=1.0, never tried 0.25; SD seems using 0.25
     def __init__(
@@ -74,6 +125,143 @@ class VectorQuantizer2(nn.Module):
 
         self.beta: float = beta
         self.embedding = nn.Embedding(self.vocab_size, self.Cvae)
+        # approximate IVF search is lossy and must never kick in implicitly:
+        # the frozen VAE sits in eval mode inside transformer train_step, so
+        # keying on self.training would corrupt the training tokens; eval-only
+        # scripts opt in via `vae.quantize.faiss_enabled = True`; the same
+        # goes for CUDA-graph replay of the quantize loop (capture inside a
+        # live DDP/dataloader step is fragile), via `cuda_graph_enabled`
+        self.faiss_enabled = False
+        self.cuda_graph_enabled = False
+        self._codebook_cache = {}  # version-tagged quantities derived from weight
+        self._graph_cache = {}  # (shape, patch_hws, to_fhat, weight ver) -> captured CUDA graph
+        self._ns_grid_cache = {}  # (pns, H, W, device) -> batched sampling grids
+
+    def _codebook_cached(self, key: str, fn):
+        # derived codebook quantities (squared norms, normalized transpose,
+        # faiss index, ...), tagged with the weight's in-place version counter:
+        # any optimizer step bumps it, so training never sees stale values
+        # while eval reuses them across calls for free
+        ver = self.embedding.weight._version
+        ent = self._codebook_cache.get(key)
+        if ent is None or ent[0] != ver:
+            ent = (ver, fn())
+            self._codebook_cache[key] = ent
+        return ent[1]
+
+    def _build_faiss_index(self):
+        W = np.ascontiguousarray(
+            self.embedding.weight.data.detach().float().cpu().numpy()
+        )
+        nlist = min(256, self.vocab_size)
+        if torch.cuda.is_available() and hasattr(faiss, "GpuIndexIVFFlat"):
+            res = faiss.StandardGpuResources()
+            index = faiss.GpuIndexIVFFlat(res, self.Cvae, nlist, faiss.METRIC_L2)
+        else:
+            index = faiss.index_factory(self.Cvae, f"IVF{nlist},PQ8")
+        index.train(W)
+        index.add(W)
+        index.nprobe = min(16, nlist)
+        return index
+
+    def _faiss_search(self, z_NC: torch.Tensor) -> torch.Tensor:
+        index = self._codebook_cached("faiss_index", self._build_faiss_index)
+        _, idx = index.search(
+            np.ascontiguousarray(z_NC.detach().float().cpu().numpy()), 1
+        )
+        return torch.from_numpy(idx[:, 0]).to(device=z_NC.device, dtype=torch.long)
+
+    def _l2_code_idx(self, z_NC: torch.Tensor) -> torch.Tensor:
+        # exact L2 nearest code; the argmin only needs the ranking of the
+        # distances, so on CUDA the -2*z@W^T term runs through tensor cores in
+        # bf16 and the distance itself is accumulated in fp32
+        W = self.embedding.weight.data
+        if not z_NC.is_cuda:
+            return torch.cdist(z_NC, W).argmin(dim=1)
+        W_h = self._codebook_cached("w_bf16", lambda: W.to(torch.bfloat16))
+        e_sq = self._codebook_cached("e_sq", lambda: W.float().square().sum(dim=1))
+        d = (z_NC.to(torch.bfloat16) @ W_h.T).float().mul_(-2)
+        d += z_NC.float().square().sum(dim=1, keepdim=True)
+        d += e_sq
+        return d.argmin(dim=1)
+
+    def _get_ns_grids(self, pns: Tuple[int, ...], H: int, W: int, device):
+        # per-mode grid_sample grids reproducing F.interpolate's sampling
+        # positions for every (pn) -> (H, W) upsample, built once per config
+        key = (pns, H, W, str(device))
+        groups = self._ns_grid_cache.get(key)
+        if groups is None:
+            pn_max = max(pns)
+            ds = torch.arange(max(H, W), dtype=torch.float32, device=device)
+            by_mode = {}
+            for si, pn in enumerate(pns):
+                if pn >= BICUBIC_MIN_PN:
+                    mode = "bicubic"
+                    sx = (ds[:W] + 0.5).mul(pn / W).sub(0.5)
+                    sy = (ds[:H] + 0.5).mul(pn / H).sub(0.5)
+                else:  # match F.interpolate's nearest source indices exactly
+                    mode = "nearest"
+                    sx = (ds[:W] * (pn / W)).floor()
+                    sy = (ds[:H] * (pn / H)).floor()
+                # normalize over the padded pn_max extent (align_corners=False)
+                gx = (2 * sx + 1) / pn_max - 1
+                gy = (2 * sy + 1) / pn_max - 1
+                grid = torch.stack(
+                    (gx.view(1, W).expand(H, W), gy.view(H, 1).expand(H, W)),
+                    dim=-1,
+                )
+                by_mode.setdefault(mode, []).append((si, grid))
+            groups = {
+                mode: ([si for si, _ in sg], torch.stack([g for _, g in sg]))
+                for mode, sg in by_mode.items()
+            }
+            self._ns_grid_cache[key] = groups
+        return groups
+
+    def _batched_upsample(
+        self, ms_h_BChw: List[torch.Tensor], H: int, W: int
+    ) -> List[torch.Tensor]:
+        # upsample all scales to (H, W) with one grid_sample per interpolation
+        # mode instead of one kernel per scale; smaller scales are
+        # replicate-padded to the largest one, matching interpolate's edge clamp
+        pns = tuple(h.shape[-1] for h in ms_h_BChw)
+        B = ms_h_BChw[0].shape[0]
+        pn_max = max(pns)
+        groups = self._get_ns_grids(pns, H, W, ms_h_BChw[0].device)
+        out: List[Optional[torch.Tensor]] = [None] * len(ms_h_BChw)
+        for mode, (sis, grid_GHW2) in groups.items():
+            G = len(sis)
+            padded = torch.stack(
+                [
+                    F.pad(
+                        ms_h_BChw[si],
+                        (0, pn_max - pns[si], 0, pn_max - pns[si]),
+                        mode="replicate",
+                    )
+                    if pns[si] != pn_max
+                    else ms_h_BChw[si]
+                    for si in sis
+                ]
+            )  # (G, B, C, pn_max, pn_max)
+            up = F.grid_sample(
+                padded.view(G * B, *padded.shape[2:]),
+                grid_GHW2.unsqueeze(1).expand(G, B, H, W, 2).reshape(G * B, H, W, 2),
+                mode=mode,
+                padding_mode="border",
+                align_corners=False,
+            ).view(G, B, -1, H, W)
+            for j, si in enumerate(sis):
+                out[si] = up[j]
+        return out
+
+    def _update_hit_ema(self, si: int, hit_V: torch.Tensor):
+        if self.record_hit == 0:
+            self.ema_vocab_hit_SV[si].copy_(hit_V)
+        elif self.record_hit < 100:
+            self.ema_vocab_hit_SV[si].mul_(0.9).add_(hit_V.mul(0.1))
+        else:
+            self.ema_vocab_hit_SV[si].mul_(0.99).add_(hit_V.mul(0.01))
+        self.record_hit += 1
 
     def eini(self, eini):
         if eini > 0:
@@ -91,20 +279,39 @@ class VectorQuantizer2(nn.Module):
         self, f_BChw: torch.Tensor, ret_usages=False
     ) -> Tuple[torch.Tensor, List[float], torch.Tensor]:
         dtype = f_BChw.dtype
-        if dtype != torch.float32:
-            f_BChw = f_BChw.float()
         B, C, H, W = f_BChw.shape
         f_no_grad = f_BChw.detach()
 
-        f_rest = f_no_grad.clone()
+        # channels-last accumulators: the per-scale permute(0,2,3,1).reshape(-1,C)
+        # flattening becomes a zero-copy view instead of a full transpose
+        f_rest = f_no_grad.clone(memory_format=torch.channels_last)
         f_hat = torch.zeros_like(f_rest)
 
-        with torch.amp.autocast('cuda', enabled=False):
-            mean_vq_loss: torch.Tensor = 0.0
-            vocab_hit_V = torch.zeros(
-                self.vocab_size, dtype=torch.float, device=f_BChw.device
-            )
+        # keep the features in the incoming dtype (halves the memory traffic of
+        # the loop under AMP); only the distance accumulation, the histogram
+        # and the final VQ loss run in fp32
+        with torch.amp.autocast(
+            'cuda',
+            enabled=dtype != torch.float32,
+            dtype=dtype if dtype != torch.float32 else torch.float16,
+        ):
+            f_hat_scales: List[torch.Tensor] = []
             SN = len(self.v_patch_nums)
+            # deferred histogram: every scale scatters into one (SN, V) buffer,
+            # reduced across ranks in a single allreduce after the loop
+            hit_SV = torch.zeros(
+                SN, self.vocab_size, dtype=torch.float, device=f_BChw.device
+            )
+            ones_N = torch.ones(B * H * W, dtype=torch.float, device=f_BChw.device)
+            # depends only on embedding.weight, not on the per-scale residual
+            e_normT = (
+                self._codebook_cached(
+                    "e_normT",
+                    lambda: F.normalize(self.embedding.weight.data.T, dim=0),
+                )
+                if self.using_znorm
+                else None
+            )
             for si, pn in enumerate(self.v_patch_nums):  # from small to large
                 # find the nearest embedding
                 if self.using_znorm:
@@ -112,67 +319,62 @@ class VectorQuantizer2(nn.Module):
                         F.interpolate(f_rest, size=(pn, pn), mode="area")
                         .permute(0, 2, 3, 1)
                         .reshape(-1, C)
-                        if (si != SN - 1)
+                        if ((pn, pn) != (H, W))
                         else f_rest.permute(0, 2, 3, 1).reshape(-1, C)
                     )
                     rest_NC = F.normalize(rest_NC, dim=-1)
-                    idx_N = torch.argmax(
-                        rest_NC @ F.normalize(self.embedding.weight.data.T, dim=0),
-                        dim=1,
-                    )
+                    idx_N = torch.argmax(rest_NC @ e_normT, dim=1)
                 else:
                     rest_NC = (
                         F.interpolate(f_rest, size=(pn, pn), mode="area")
                         .permute(0, 2, 3, 1)
                         .reshape(-1, C)
-                        if (si != SN - 1)
+                        if ((pn, pn) != (H, W))
                         else f_rest.permute(0, 2, 3, 1).reshape(-1, C)
                     )
-                    d_no_grad = torch.sum(
-                        rest_NC.square(), dim=1, keepdim=True
-                    ) + torch.sum(
-                        self.embedding.weight.data.square(), dim=1, keepdim=False
-                    )
-                    d_no_grad.addmm_(
-                        rest_NC, self.embedding.weight.data.T, alpha=-2, beta=1
-                    )  # (B*h*w, vocab_size)
-                    idx_N = torch.argmin(d_no_grad, dim=1)
+                    if self.faiss_enabled and faiss is not None:
+                        idx_N = self._faiss_search(rest_NC)
+                    else:
+                        idx_N = self._l2_code_idx(rest_NC)
 
-                hit_V = idx_N.bincount(minlength=self.vocab_size).float()
-                if self.training:
-                    if dist.initialized():
-                        handler = tdist.all_reduce(hit_V, async_op=True)
+                hit_SV[si].scatter_add_(0, idx_N, ones_N[: idx_N.numel()])
 
                 # calc loss
                 idx_Bhw = idx_N.view(B, pn, pn)
+                emb_BChw = (
+                    self.embedding(idx_Bhw)
+                    .permute(0, 3, 1, 2)
+                    .contiguous(memory_format=torch.channels_last)
+                )
+                phi = self.quant_resi.get_slot(si, SN)
                 h_BChw = (
-                    F.interpolate(
-                        self.embedding(idx_Bhw).permute(0, 3, 1, 2),
-                        size=(H, W),
-                        mode="bicubic",
-                    ).contiguous()
-                    if (si != SN - 1)
-                    else self.embedding(idx_Bhw).permute(0, 3, 1, 2).contiguous()
+                    _upsample_phi(emb_BChw, (H, W), phi)
+                    if ((pn, pn) != (H, W))
+                    else phi(emb_BChw)
                 )
-                h_BChw = self.quant_resi[si / (SN - 1)](h_BChw)
-                f_hat = f_hat + h_BChw
-                f_rest -= h_BChw
-
-                if self.training and dist.initialized():
-                    handler.wait()
-                    if self.record_hit == 0:
-                        self.ema_vocab_hit_SV[si].copy_(hit_V)
-                    elif self.record_hit < 100:
-                        self.ema_vocab_hit_SV[si].mul_(0.9).add_(hit_V.mul(0.1))
-                    else:
-                        self.ema_vocab_hit_SV[si].mul_(0.99).add_(hit_V.mul(0.01))
-                    self.record_hit += 1
-                vocab_hit_V.add_(hit_V)
-                mean_vq_loss += F.mse_loss(f_hat.data, f_BChw).mul_(
-                    self.beta
-                ) + F.mse_loss(f_hat, f_no_grad)
-
-            mean_vq_loss *= 1.0 / SN
+                f_hat, f_rest = _residual_update(f_hat, f_rest, h_BChw)
+                f_hat_scales.append(f_hat)
+
+            sync_hits = self.training and dist.initialized()
+            if sync_hits:  # overlaps the loss reduction below
+                handler = tdist.all_reduce(hit_SV, async_op=True)
+
+            # one fused reduction over all scales instead of 2*SN small ones;
+            # the mean over the stacked dim equals the per-scale average, so
+            # the explicit 1/SN rescale goes away
+            f_hat_SBChw = torch.stack(f_hat_scales, dim=0).float()
+            mean_vq_loss = F.mse_loss(
+                f_hat_SBChw.detach(),
+                f_BChw.float().unsqueeze(0).expand_as(f_hat_SBChw),
+            ).mul_(self.beta) + F.mse_loss(
+                f_hat_SBChw, f_no_grad.float().unsqueeze(0).expand_as(f_hat_SBChw)
+            )
+
+            if sync_hits:
+                handler.wait()
+                for si in range(SN):
+                    self._update_hit_ema(si, hit_SV[si])
+
             f_hat = (f_hat.data - f_no_grad).add_(f_BChw)
 
         margin = (
@@ -202,16 +404,20 @@ class VectorQuantizer2(nn.Module):
         SN = len(self.v_patch_nums)
         if all_to_max_scale:
             f_hat = ms_h_BChw[0].new_zeros(B, self.Cvae, H, W, dtype=torch.float32)
+            # one pre-allocated (SN,B,C,H,W) buffer instead of SN clone() calls
+            out_SBChw = (
+                None if last_one else f_hat.new_empty(SN, B, self.Cvae, H, W)
+            )
             for si, pn in enumerate(self.v_patch_nums):  # from small to large
-                h_BChw = ms_h_BChw[si]
+                phi = self.quant_resi.get_slot(si, SN)
                 if si < len(self.v_patch_nums) - 1:
-                    h_BChw = F.interpolate(h_BChw, size=(H, W), mode="bicubic")
-                h_BChw = self.quant_resi[si / (SN - 1)](h_BChw)
-                f_hat.add_(h_BChw)
-                if last_one:
-                    ls_f_hat_BChw = f_hat
+                    h_BChw = _upsample_phi(ms_h_BChw[si], (H, W), phi)
                 else:
-                    ls_f_hat_BChw.append(f_hat.clone())
+                    h_BChw = phi(ms_h_BChw[si])
+                f_hat.add_(h_BChw)
+                if not last_one:
+                    out_SBChw[si].copy_(f_hat, non_blocking=True)
+            ls_f_hat_BChw = f_hat if last_one else list(out_SBChw.unbind(0))
         else:
             # WARNING: this is not the case in VQ-VAE training (where we'll interpolate every token map to the max scale), so it may cause some training-inference inconsistency
             # WARNING: this should only be used for experimental visualization
@@ -224,7 +430,7 @@ class VectorQuantizer2(nn.Module):
             )
             for si, pn in enumerate(self.v_patch_nums):  # from small to large
                 f_hat = F.interpolate(f_hat, size=(pn, pn), mode="bicubic")
-                h_BChw = self.quant_resi[si / (SN - 1)](ms_h_BChw[si])
+                h_BChw = self.quant_resi.get_slot(si, SN)(ms_h_BChw[si])
                 f_hat.add_(h_BChw)
                 if last_one:
                     ls_f_hat_BChw = f_hat
@@ -243,10 +449,6 @@ class VectorQuantizer2(nn.Module):
     ]:  # z_BChw is the feature from inp_img_no_grad
         B, C, H, W = f_BChw.shape
         f_no_grad = f_BChw.detach()
-        f_rest = f_no_grad.clone()
-        f_hat = torch.zeros_like(f_rest)
-
-        f_hat_or_idx_Bl: List[torch.Tensor] = []
 
         patch_hws = [
             (pn, pn) if isinstance(pn, int) else (pn[0], pn[1])
@@ -256,48 +458,110 @@ class VectorQuantizer2(nn.Module):
             patch_hws[-1][0] == H and patch_hws[-1][1] == W
         ), f"{patch_hws[-1]=} != ({H=}, {W=})"
 
+        # at inference the per-scale kernels are tiny for small pn, so launch
+        # overhead dominates; replay the whole loop as one captured CUDA graph
+        # (faiss search is an external call and cannot be captured, so prefer it
+        # when available and fall back to graphs otherwise)
+        if (
+            self.cuda_graph_enabled
+            and not self.training
+            and f_BChw.is_cuda
+            and (self.using_znorm or not (self.faiss_enabled and faiss is not None))
+        ):
+            return self._quantize_scales_graphed(f_no_grad, patch_hws, to_fhat)
+        return self._quantize_scales(f_no_grad, patch_hws, to_fhat)
+
+    def _quantize_scales_graphed(
+        self, f_no_grad: torch.Tensor, patch_hws, to_fhat: bool
+    ) -> List[torch.Tensor]:
+        # the captured graph bakes in pointers to the version-tagged codebook
+        # tensors, so it is only valid for the weight version it was built
+        # against (same invalidation rule as _codebook_cached)
+        ver = self.embedding.weight._version
+        key = (tuple(f_no_grad.shape), tuple(patch_hws), to_fhat, ver)
+        entry = self._graph_cache.get(key)
+        if entry is None:
+            for stale in [k for k in self._graph_cache if k[3] != ver]:
+                del self._graph_cache[stale]
+            static_in = f_no_grad.clone()
+            s = torch.cuda.Stream()
+            s.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(s):  # warmup before capture
+                for _ in range(3):
+                    self._quantize_scales(
+                        static_in, patch_hws, to_fhat, use_faiss=False
+                    )
+            torch.cuda.current_stream().wait_stream(s)
+            g = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(g):
+                static_out = self._quantize_scales(
+                    static_in, patch_hws, to_fhat, use_faiss=False
+                )
+            entry = self._graph_cache[key] = (static_in, g, static_out)
+        static_in, g, static_out = entry
+        static_in.copy_(f_no_grad)
+        g.replay()
+        return [t.clone() for t in static_out]
+
+    def _quantize_scales(
+        self, f_no_grad: torch.Tensor, patch_hws, to_fhat: bool, use_faiss=True
+    ) -> List[torch.Tensor]:
+        B, C, H, W = f_no_grad.shape
+        # channels-last accumulators: the per-scale permute(0,2,3,1).reshape(-1,C)
+        # flattening becomes a zero-copy view instead of a full transpose
+        f_rest = f_no_grad.clone(memory_format=torch.channels_last)
+        f_hat = torch.zeros_like(f_rest)
+
         SN = len(patch_hws)
+        # one pre-allocated (SN,B,C,H,W) buffer instead of SN clone() calls
+        out_SBChw = f_hat.new_empty(SN, B, C, H, W) if to_fhat else None
+        f_hat_or_idx_Bl: List[torch.Tensor] = []
+        # depends only on embedding.weight, not on the per-scale residual
+        e_normT = (
+            self._codebook_cached(
+                "e_normT",
+                lambda: F.normalize(self.embedding.weight.data.T, dim=0),
+            )
+            if self.using_znorm
+            else None
+        )
         for si, (ph, pw) in enumerate(patch_hws):  # from small to large
             # find the nearest embedding
             z_NC = (
                 F.interpolate(f_rest, size=(ph, pw), mode="area")
                 .permute(0, 2, 3, 1)
                 .reshape(-1, C)
-                if (si != SN - 1)
+                if ((ph, pw) != (H, W))
                 else f_rest.permute(0, 2, 3, 1).reshape(-1, C)
             )
             if self.using_znorm:
                 z_NC = F.normalize(z_NC, dim=-1)
-                idx_N = torch.argmax(
-                    z_NC @ F.normalize(self.embedding.weight.data.T, dim=0), dim=1
-                )
+                idx_N = torch.argmax(z_NC @ e_normT, dim=1)
+            elif use_faiss and self.faiss_enabled and faiss is not None:
+                idx_N = self._faiss_search(z_NC)
             else:
-                d_no_grad = torch.sum(z_NC.square(), dim=1, keepdim=True) + torch.sum(
-                    self.embedding.weight.data.square(), dim=1, keepdim=False
-                )
-                d_no_grad.addmm_(
-                    z_NC, self.embedding.weight.data.T, alpha=-2, beta=1
-                )  # (B*h*w, vocab_size)
-                idx_N = torch.argmin(d_no_grad, dim=1)
-
-            idx_Bhw = idx_N.view(B, ph, pw)
-            h_BChw = (
-                F.interpolate(
-                    self.embedding(idx_Bhw).permute(0, 3, 1, 2),
-                    size=(H, W),
-                    mode="bicubic",
-                ).contiguous()
-                if (si != SN - 1)
-                else self.embedding(idx_Bhw).permute(0, 3, 1, 2).contiguous()
+                idx_N = self._l2_code_idx(z_NC)
+
+            # no grads needed here: gather codebook rows directly, giving NHWC
+            # data whose channels-first permute is already a channels-last view
+            emb_BChw = (
+                self.embedding.weight.data.index_select(0, idx_N)
+                .view(B, ph, pw, C)
+                .permute(0, 3, 1, 2)
             )
-            h_BChw = self.quant_resi[si / (SN - 1)](h_BChw)
-            f_hat.add_(h_BChw)
-            f_rest.sub_(h_BChw)
-            f_hat_or_idx_Bl.append(
-                f_hat.clone() if to_fhat else idx_N.reshape(B, ph * pw)
+            phi = self.quant_resi.get_slot(si, SN)
+            h_BChw = (
+                _upsample_phi(emb_BChw, (H, W), phi)
+                if ((ph, pw) != (H, W))
+                else phi(emb_BChw)
             )
+            _residual_update_(f_hat, f_rest, h_BChw)
+            if to_fhat:
+                out_SBChw[si].copy_(f_hat, non_blocking=True)
+            else:
+                f_hat_or_idx_Bl.append(idx_N.reshape(B, ph * pw))
 
-        return f_hat_or_idx_Bl
+        return list(out_SBChw.unbind(0)) if to_fhat else f_hat_or_idx_Bl
 
     # ===================== idxBl_to_var_input: only used in VAR training, for getting teacher-forcing input =====================
     def idxBl_to_ns_input(self, gt_ms_idx_Bl: List[torch.Tensor]) -> torch.Tensor:
@@ -308,17 +572,19 @@ class VectorQuantizer2(nn.Module):
         SN = len(self.v_patch_nums)
 
         f_hat = gt_ms_idx_Bl[0].new_zeros(B, C, H, W, dtype=torch.float32)
-        pn_next: int = self.v_patch_nums[0]
+
+        # the per-scale upsamples are independent of the f_hat accumulation, so
+        # batch them; only the accumulate+area-pool chain stays sequential
+        ms_h_BChw = [
+            self.embedding(gt_ms_idx_Bl[si])
+            .transpose_(1, 2)
+            .view(B, C, self.v_patch_nums[si], self.v_patch_nums[si])
+            for si in range(SN - 1)
+        ]
+        ups = self._batched_upsample(ms_h_BChw, H, W) if SN > 1 else []
 
         for si in range(SN - 1):
-            h_BChw = F.interpolate(
-                self.embedding(gt_ms_idx_Bl[si])
-                .transpose_(1, 2)
-                .view(B, C, pn_next, pn_next),
-                size=(H, W),
-                mode="bicubic",
-            )
-            f_hat.add_(self.quant_resi[si / (SN - 1)](h_BChw))
+            f_hat.add_(self.quant_resi.get_slot(si, SN)(ups[si]))
             pn_next = self.v_patch_nums[si + 1]
             next_scales.append(
                 F.interpolate(f_hat, size=(pn_next, pn_next), mode="area")
@@ -361,9 +627,9 @@ class VectorQuantizer2(nn.Module):
 
             # randomly select the indices of the tokens to mask out
             # we should be masking out different tokens from all the tokens in the batch
-            idx_to_mask_si = torch.multinomial(
-                torch.ones(n_tokens_si), n_tokens_mask, replacement=False
-            ).to(gt_ms_idx_Bl[si].device)
+            idx_to_mask_si = torch.randperm(
+                n_tokens_si, device=gt_ms_idx_Bl[si].device
+            )[:n_tokens_mask]
 
             # add the global position to the indices to mask out
             idx_to_mask_si += cur_l
@@ -374,16 +640,14 @@ class VectorQuantizer2(nn.Module):
             cur_l += n_tokens_si
 
             # note that we do not accumulate the information from the previous scales
-            h_BChw = F.interpolate(
+            h_BChw = _upsample_phi(
                 self.embedding(gt_ms_idx_Bl[si]).transpose_(1, 2).view(B, C, pn, pn),
-                size=(H, W),
-                mode="bicubic",
+                (H, W),
+                self.quant_resi.get_slot(si, SN),
             )
 
             next_scales.append(
-                F.interpolate(
-                    self.quant_resi[si / (SN - 1)](h_BChw), size=(pn, pn), mode="area"
-                )
+                F.interpolate(h_BChw, size=(pn, pn), mode="area")
                 .view(B, C, -1)
                 .transpose(1, 2)
             )
@@ -399,17 +663,14 @@ class VectorQuantizer2(nn.Module):
     ) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
         HW = self.v_patch_nums[-1]
         if si != SN - 1:
-            h = self.quant_resi[si / (SN - 1)](
-                F.interpolate(h_BChw, size=(HW, HW), mode="bicubic")
+            h = _upsample_phi(
+                h_BChw, (HW, HW), self.quant_resi.get_slot(si, SN)
             )  # conv after upsample
-            f_hat.add_(h)
-            return f_hat, F.interpolate(
-                f_hat,
-                size=(self.v_patch_nums[si + 1], self.v_patch_nums[si + 1]),
-                mode="area",
+            return f_hat, _accumulate_and_pool(
+                f_hat, h, (self.v_patch_nums[si + 1], self.v_patch_nums[si + 1])
             )
         else:
-            h = self.quant_resi[si / (SN - 1)](h_BChw)
+            h = self.quant_resi.get_slot(si, SN)(h_BChw)
             f_hat.add_(h)
             return f_hat, f_hat
 
@@ -417,8 +678,8 @@ class VectorQuantizer2(nn.Module):
         self, si: int, SN: int, f_hat: torch.Tensor, h_BChw: torch.Tensor
     ):
         HW = self.v_patch_nums[-1]
-        h = self.quant_resi[si / (SN - 1)](
-            F.interpolate(h_BChw, size=(HW, HW), mode="bicubic")
+        h = _upsample_phi(
+            h_BChw, (HW, HW), self.quant_resi.get_slot(si, SN)
         )  # conv after upsample
         f_hat_int = F.interpolate(
             f_hat.clone(),
@@ -442,6 +703,9 @@ class Phi(nn.Conv2d):
             padding=ks // 2,
         )
         self.resi_ratio = abs(quant_resi)
+        # channels-last weights so the residual conv consumes the
+        # channels-last f_hat/f_rest pipeline without a reformat
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, h_BChw):
         return h_BChw.mul(1 - self.resi_ratio) + super().forward(h_BChw).mul_(
@@ -457,6 +721,9 @@ class PhiShared(nn.Module):
     def __getitem__(self, _) -> Phi:
         return self.qresi
 
+    def get_slot(self, si: int, SN: int) -> Phi:
+        return self.qresi
+
 
 class PhiPartiallyShared(nn.Module):
     def __init__(self, qresi_ls: nn.ModuleList):
@@ -468,9 +735,26 @@ class PhiPartiallyShared(nn.Module):
             if K == 4
             else np.linspace(1 / 2 / K, 1 - 1 / 2 / K, K)
         )
+        self._slot_cache = {}  # at_from_0_to_1 -> nearest tick index
+        self._slot_tables = {}  # SN -> per-si tick index
 
     def __getitem__(self, at_from_0_to_1: float) -> Phi:
-        return self.qresi_ls[np.argmin(np.abs(self.ticks - at_from_0_to_1)).item()]
+        slot = self._slot_cache.get(at_from_0_to_1)
+        if slot is None:
+            slot = self._slot_cache[at_from_0_to_1] = int(
+                np.argmin(np.abs(self.ticks - at_from_0_to_1))
+            )
+        return self.qresi_ls[slot]
+
+    def get_slot(self, si: int, SN: int) -> Phi:
+        # integer indexing: no float division or tick argmin on the hot path
+        table = self._slot_tables.get(SN)
+        if table is None:
+            table = self._slot_tables[SN] = tuple(
+                int(np.argmin(np.abs(self.ticks - i / max(SN - 1, 1))))
+                for i in range(SN)
+            )
+        return self.qresi_ls[table[si]]
 
     def extra_repr(self) -> str:
         return f"ticks={self.ticks}"
@@ -486,11 +770,26 @@ class PhiNonShared(nn.ModuleList):
             if K == 4
             else np.linspace(1 / 2 / K, 1 - 1 / 2 / K, K)
         )
+        self._slot_cache = {}  # at_from_0_to_1 -> nearest tick index
+        self._slot_tables = {}  # SN -> per-si tick index
 
     def __getitem__(self, at_from_0_to_1: float) -> Phi:
-        return super().__getitem__(
-            np.argmin(np.abs(self.ticks - at_from_0_to_1)).item()
-        )
+        slot = self._slot_cache.get(at_from_0_to_1)
+        if slot is None:
+            slot = self._slot_cache[at_from_0_to_1] = int(
+                np.argmin(np.abs(self.ticks - at_from_0_to_1))
+            )
+        return super().__getitem__(slot)
+
+    def get_slot(self, si: int, SN: int) -> Phi:
+        # integer indexing: no float division or tick argmin on the hot path
+        table = self._slot_tables.get(SN)
+        if table is None:
+            table = self._slot_tables[SN] = tuple(
+                int(np.argmin(np.abs(self.ticks - i / max(SN - 1, 1))))
+                for i in range(SN)
+            )
+        return super().__getitem__(table[si])
 
     def extra_repr(self) -> str:
         return f"ticks={self.ticks}"
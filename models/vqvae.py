@@ -179,7 +179,7 @@ class VQVAE(nn.Module):
                 size=(H, W),
                 mode="bicubic",
             )
-            f_hat.add_(self.quantize.quant_resi[si / (SN - 1)](h_BChw))
+            f_hat.add_(self.quantize.quant_resi.get_slot(si, SN)(h_BChw))
             cur_l += pn * pn
             (
                 f_hats_or_imgs.append(self.fhat_to_img(f_hat))
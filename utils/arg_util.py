@@ -5,7 +5,10 @@
 
 # Adapted from https://github.com/FoundationVision/VAR/blob/main/utils/arg_util.py
 
+import ast
+import atexit
 import json
+import operator
 import os
 import random
 import re
@@ -16,10 +19,16 @@ from typing import Optional, Union
 import numpy as np
 import torch
 import yaml
+try:
+    from yaml import CSafeLoader as _BaseLoader    # libyaml: ~5-10x faster parsing
+except ImportError:
+    from yaml import SafeLoader as _BaseLoader
 from tap import Tap
 
 import dist
 
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
 def _seed_everything(seed, benchmark: bool):
         torch.backends.cudnn.enabled = True
         torch.backends.cudnn.benchmark = benchmark
@@ -27,49 +36,77 @@ def _seed_everything(seed, benchmark: bool):
             torch.backends.cudnn.deterministic = False
         else:
             torch.backends.cudnn.deterministic = True
-            seed = seed * dist.get_world_size() + dist.get_rank()
-            os.environ['PYTHONHASHSEED'] = str(seed)
-            random.seed(seed)
-            np.random.seed(seed)
-            torch.manual_seed(seed)
+            # PYTHONHASHSEED is only honored before interpreter start, so it is not set here
+            s = int(seed) * dist.get_world_size() + dist.get_rank()
+            random.seed(s)
+            np.random.seed(s & 0xFFFFFFFF)  # np's Mersenne Twister only accepts 32-bit seeds
+            torch.manual_seed(s)
             if torch.cuda.is_available():
-                torch.cuda.manual_seed(seed)
-                torch.cuda.manual_seed_all(seed)
+                torch.cuda.manual_seed_all(s)   # covers every device, manual_seed would be redundant
 
 
 def _set_tf32(tf32: bool):
     if torch.cuda.is_available():
-        torch.backends.cudnn.allow_tf32 = bool(tf32)
-        torch.backends.cuda.matmul.allow_tf32 = bool(tf32)
-        if hasattr(torch, 'set_float32_matmul_precision'):
-            torch.set_float32_matmul_precision('high' if tf32 else 'highest')
-            print(f'[tf32] [precis] torch.get_float32_matmul_precision(): {torch.get_float32_matmul_precision()}')
-        print(f'[tf32] [ conv ] torch.backends.cudnn.allow_tf32: {torch.backends.cudnn.allow_tf32}')
-        print(f'[tf32] [matmul] torch.backends.cuda.matmul.allow_tf32: {torch.backends.cuda.matmul.allow_tf32}')
+        cc_major = torch.cuda.get_device_capability(0)[0]
+        if tf32 and cc_major < 8:   # tf32 tensor cores need Ampere or newer
+            print(f'[tf32] compute capability {cc_major}.x is pre-Ampere, tf32 is not supported; keeping fp32')
+            tf32 = False
+        torch.backends.cudnn.allow_tf32 = tf32
+        torch.backends.cuda.matmul.allow_tf32 = tf32
+        if hasattr(torch.backends.cuda.matmul, 'fp32_precision'):   # torch>=2.8 replacement for allow_tf32
+            torch.backends.cuda.matmul.fp32_precision = 'tf32' if tf32 else 'ieee'
+            torch.backends.cudnn.conv.fp32_precision = 'tf32' if tf32 else 'ieee'
+        torch.set_float32_matmul_precision('high' if tf32 else 'highest')
+        print(f'[tf32] precis={torch.get_float32_matmul_precision()}, conv={torch.backends.cudnn.allow_tf32}, matmul={torch.backends.cuda.matmul.allow_tf32}')
   
-def _compile_model(m, fast):
+def _compile_model(m, fast, dynamic=False, fullgraph=False):
         if fast == 0:
             return m
+        # 'max-autotune' embeds CUDA graphs, which crash or regress on varying shapes;
+        # the no-cudagraphs variant keeps the inductor tuning without that risk
         return torch.compile(m, mode={
             1: 'reduce-overhead',
-            2: 'max-autotune',
+            2: 'max-autotune-no-cudagraphs',
             3: 'default',
-        }[fast]) if hasattr(torch, 'compile') else m
+        }[fast], dynamic=dynamic, fullgraph=fullgraph) if hasattr(torch, 'compile') else m
                 
+def _to_py(v):
+    # explicit isinstance checks instead of hasattr(v, 'item'), which ran __getattr__
+    # on arbitrary objects; tensors are detached to cpu so json never sees a device sync mid-write
+    if isinstance(v, torch.Tensor):
+        v = v.detach().cpu()
+        return v.item() if v.numel() == 1 else v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    return v
+
+#https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
+_FLOAT_RE = re.compile(u'''^(?:
+    [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+    |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+    |\\.[0-9_]+(?:[eE][-+][0-9]+)?
+    |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
+    |[-+]?\\.(?:inf|Inf|INF)
+    |\\.(?:nan|NaN|NAN))$''', re.X)
+_FLOAT_FIRST_CHARS = list(u'-+0123456789.')    # must stay a list per the yaml resolver API
+_YAML_LOADER_READY = False
+
+_BAD_STATE_LINE = re.compile(r'<bound|device\(')    # non-literal lines in old-format state strings
+
+_PN_PRESETS = {
+    '256': (1, 2, 3, 4, 5, 6, 8, 10, 13, 16),
+    '512': (1, 2, 3, 4, 6, 9, 13, 18, 24, 32),
+    '1024': (1, 2, 3, 4, 5, 7, 9, 12, 16, 21, 27, 36, 48, 64),
+}
+
 def _get_yaml_loader():
-    #https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
-    loader = yaml.SafeLoader
-    loader.add_implicit_resolver(
-        u'tag:yaml.org,2002:float',
-        re.compile(u'''^(?:
-        [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
-        |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
-        |\\.[0-9_]+(?:[eE][-+][0-9]+)?
-        |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
-        |[-+]?\\.(?:inf|Inf|INF)
-        |\\.(?:nan|NaN|NAN))$''', re.X),
-        list(u'-+0123456789.'))
-    return loader
+    global _YAML_LOADER_READY
+    if not _YAML_LOADER_READY:     # register the float resolver only once
+        if not getattr(yaml, '__with_libyaml__', False):
+            print(f'[yaml] libyaml is not available, falling back to the pure-Python SafeLoader', file=sys.stderr)
+        _BaseLoader.add_implicit_resolver(u'tag:yaml.org,2002:float', _FLOAT_RE, _FLOAT_FIRST_CHARS)
+        _YAML_LOADER_READY = True
+    return _BaseLoader
       
 class Args(Tap):
     data_path: str = '/path/to/imagenet'
@@ -131,7 +168,7 @@ class Args(Tap):
     workers: int = 0        # num workers; 0: auto, -1: don't use multiprocessing in DataLoader
 
     # would be automatically set in runtime
-    cmd: str = ' '.join(sys.argv[1:])  # [automatically set; don't specify this]
+    cmd: str = ''               # [automatically set; don't specify this]
     
     acc_mean: float = None      # [automatically set; don't specify this]
     acc_tail: float = None      # [automatically set; don't specify this]
@@ -175,37 +212,46 @@ class Args(Tap):
 
 
     #evlaution
-    eval_classes = [41, 595, 732, 521, 388, 154, 600, 434, 338, 752, 688, 748, 816, 660, 77, 930, 816, 498, 676, 50, 630, 593, 926, 142, 197, 79, 775, 40, 532, 212, 227, 621, 55, 809, 936, 809, 179, 835, 412, 770, 597, 608, 342, 305, 874, 822, 106, 114, 977, 13, 619, 770, 765, 87, 596, 269, 9, 669, 531, 385, 799, 811, 753, 221]
+    eval_classes: tuple = (41, 595, 732, 521, 388, 154, 600, 434, 338, 752, 688, 748, 816, 660, 77, 930, 816, 498, 676, 50, 630, 593, 926, 142, 197, 79, 775, 40, 532, 212, 227, 621, 55, 809, 936, 809, 179, 835, 412, 770, 597, 608, 342, 305, 874, 822, 106, 114, 977, 13, 619, 770, 765, 87, 596, 269, 9, 669, 531, 385, 799, 811, 753, 221)  # hashable, so consumers can cache per-class artifacts keyed by it
     checkpoint_frequency: int = 10 #save checkpoint every n epochs
     max_num_checkpoints: int = 3 #maximum number of checkpoints to keep
     ckpt_path: str = None #path to the checkpoint to evaluate
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # cache the serializable keys once; state_dict/__str__ are called on every log flush
+        self._serializable_keys = tuple(k for k in self.class_variables.keys() if k not in {'device', 'dbg_ks_fp'})
+        self._attrget = operator.attrgetter(*self._serializable_keys)
+        self._log_fp = None
+
     def seed_everything(self, benchmark: bool):
         _seed_everything(self.seed, benchmark)
-        
+
     same_seed_for_all_ranks: int = 0     # this is only for distributed sampler
 
-    def get_different_generator_for_each_rank(self) -> Optional[torch.Generator]:   # for random augmentation
+    def get_different_generator_for_each_rank(self, device='cpu') -> Optional[torch.Generator]:   # for random augmentation
         if self.seed is None:
             return None
-        g = torch.Generator()
-        g.manual_seed(self.seed * dist.get_world_size() + dist.get_rank())
-        return g
+        cache = self.__dict__.setdefault('_gen_cache', {})
+        if device not in cache:
+            g = torch.Generator(device=device)
+            g.manual_seed(self.seed * dist.get_world_size() + dist.get_rank())
+            cache[device] = g
+        return cache[device]
 
     def compile_model(self, m, fast):
-        return _compile_model(m, fast)
+        # multi-scale patch_nums means per-scale input shapes; mark them dynamic up front
+        dynamic = self.patch_nums is not None and len(self.patch_nums) > 1
+        return _compile_model(m, fast, dynamic=dynamic)
 
     def state_dict(self, key_ordered=True) -> Union[OrderedDict, dict]:
-        d = (OrderedDict if key_ordered else dict)()
         # self.as_dict() would contain methods, but we only need variables
-        for k in self.class_variables.keys():
-            if k not in {'device'}:     # these are not serializable
-                d[k] = getattr(self, k)
-        return d
+        return (OrderedDict if key_ordered else dict)(zip(self._serializable_keys, self._attrget(self)))
 
     def load_state_dict(self, d: Union[OrderedDict, dict, str]):
         if isinstance(d, str):  # for compatibility with old version
-            d: dict = eval('\n'.join([l for l in d.splitlines() if '<bound' not in l and 'device(' not in l]))
+            # literal_eval instead of eval: no code execution on a saved string
+            d: dict = ast.literal_eval('\n'.join(l for l in d.splitlines() if not _BAD_STATE_LINE.search(l)))
         for k in d.keys():
             try:
                 setattr(self, k, d[k])
@@ -225,35 +271,34 @@ class Args(Tap):
                 json.dump({'is_master': dist.is_master(), 'name': self.experiment, 'cmd': self.cmd}, fp, indent=0)
                 fp.write('\n')
 
-        log_dict = {}
-        for k, v in {
+        log_dict = {k: _to_py(v) for k, v in {
             'it': self.cur_it, 'ep': self.cur_ep,
             'lr': self.cur_lr, 'wd': self.cur_wd, 'grad_norm': self.grad_norm,
             'L_mean': self.L_mean, 'L_tail': self.L_tail, 'acc_mean': self.acc_mean, 'acc_tail': self.acc_tail,
             'vL_mean': self.vL_mean, 'vL_tail': self.vL_tail, 'vacc_mean': self.vacc_mean, 'vacc_tail': self.vacc_tail,
             'remain_time': self.remain_time, 'finish_time': self.finish_time,
-        }.items():
-            if hasattr(v, 'item'): v = v.item()
-            log_dict[k] = v
-        with open(self.log_txt_path, 'a') as fp:
-            fp.write(f'{log_dict}\n')
+        }.items()}
+        if self._log_fp is None:    # open once, line-buffered, instead of an open/close pair per step
+            self._log_fp = open(self.log_txt_path, 'a', buffering=1)
+            atexit.register(self._log_fp.close)
+        self._log_fp.write(json.dumps(log_dict) + '\n')
 
     def __str__(self):
-        s = []
-        for k in self.class_variables.keys():
-            if k not in {'device', 'dbg_ks_fp'}:     # these are not serializable
-                s.append(f'  {k:20s}: {getattr(self, k)}')
-        s = '\n'.join(s)
+        s = '\n'.join(f'  {k:20s}: {v}' for k, v in zip(self._serializable_keys, self._attrget(self)))
         return f'{{\n{s}\n}}\n'
 
 
+_ARGS_SINGLETON: Optional[Args] = None
+
+
 def init_dist_and_get_args(init_dist: bool = True, validate_args=True) -> Args:
-    for i in range(len(sys.argv)):
-        if sys.argv[i].startswith('--local-rank=') or sys.argv[i].startswith('--local_rank='):
-            del sys.argv[i]
-            break
+    global _ARGS_SINGLETON
+    if _ARGS_SINGLETON is not None:     # re-entrant callers (sweeps, test fixtures) reuse the parsed args
+        return _ARGS_SINGLETON
+    sys.argv[:] = [a for a in sys.argv if not a.startswith(('--local-rank=', '--local_rank='))]
     args = Args(explicit_bool=True).parse_args(known_only=True)
-    
+    args.cmd = ' '.join(sys.argv[1:])   # captured here, after argv cleanup, not at class definition
+
     loader = _get_yaml_loader()
 
     try:
@@ -282,29 +327,31 @@ def init_dist_and_get_args(init_dist: bool = True, validate_args=True) -> Args:
         print(f'======================================================================================\n\n')
 
     #update the local output directory
-    args.shared_dir_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), args.shared_dir_path) 
-    args.experiment_dir_path = os.path.join(args.shared_dir_path, f'experiments/{args.experiment}')
-    args.base_experiment_dir_path = os.path.join(args.shared_dir_path, f'experiments/{args.base_experiment}')
+    if not os.path.isabs(args.shared_dir_path):     # don't override a user-supplied absolute path
+        args.shared_dir_path = os.path.join(_REPO_ROOT, args.shared_dir_path)
+    experiments_root = f'{args.shared_dir_path}/experiments'
+    args.experiment_dir_path = f'{experiments_root}/{args.experiment}'
+    args.base_experiment_dir_path = f'{experiments_root}/{args.base_experiment}'
 
     # init torch distributed
     from utils import misc
-    os.makedirs(args.experiment_dir_path, exist_ok=True)
+    # one mkdir per node instead of a per-rank race on the shared filesystem;
+    # dist ranks are not set up yet, so read the launcher env directly
+    if int(os.environ.get('LOCAL_RANK', 0)) == 0:
+        os.makedirs(args.experiment_dir_path, exist_ok=True)
     if init_dist:
         misc.init_distributed_mode(local_out_path=args.experiment_dir_path, timeout=30)
+    dist.barrier()  # make sure the dir exists on every rank before it is used
 
     # set env
     args.set_tf32(args.tf32)
+    # the dataloader always serves data_load_reso = max(resos) and the convs
+    # run at fixed shapes, so cudnn autotuning never re-triggers mid-run
     args.seed_everything(benchmark=True)
 
     # update args: data loading
     args.device = dist.get_device()
-    if args.pn == '256':
-        args.pn = '1_2_3_4_5_6_8_10_13_16'
-    elif args.pn == '512':
-        args.pn = '1_2_3_4_6_9_13_18_24_32'
-    elif args.pn == '1024':
-        args.pn = '1_2_3_4_5_7_9_12_16_21_27_36_48_64'
-    args.patch_nums = tuple(map(int, args.pn.replace('-', '_').split('_')))
+    args.patch_nums = _PN_PRESETS.get(args.pn) or tuple(int(x) for x in args.pn.replace('-', '_').split('_'))
     args.resos = tuple(pn * args.patch_size for pn in args.patch_nums)
     args.data_load_reso = max(args.resos)
 
@@ -321,10 +368,11 @@ def init_dist_and_get_args(init_dist: bool = True, validate_args=True) -> Args:
         args.wp = args.ep * 1/50
         
     # update args: paths
-    args.log_txt_path = os.path.join(args.experiment_dir_path, 'log.txt')
-    args.last_ckpt_path = os.path.join(args.experiment_dir_path, f'ar-ckpt-last.pth')
+    args.log_txt_path = f'{args.experiment_dir_path}/log.txt'
+    args.last_ckpt_path = f'{args.experiment_dir_path}/ar-ckpt-last.pth'
 
     # update args: wandb
     args.wandb_id = f"{args.experiment}"
-    
+
+    _ARGS_SINGLETON = args
     return args
\ No newline at end of file
@@ -55,7 +55,8 @@ def init_distributed_mode(local_out_path, only_sync_master=False, timeout=30):
         print(f'{">"*75}  NCCL Error  {"<"*75}', flush=True)
         time.sleep(10)
     
-    if local_out_path is not None: os.makedirs(local_out_path, exist_ok=True)
+    if local_out_path is not None and dist.is_local_master(): os.makedirs(local_out_path, exist_ok=True)
+    dist.barrier()
     _change_builtin_print(dist.is_local_master())
     if (dist.is_master() if only_sync_master else dist.is_local_master()) and local_out_path is not None and len(local_out_path):
         sys.stdout, sys.stderr = SyncPrint(local_out_path, sync_stdout=True), SyncPrint(local_out_path, sync_stdout=False)